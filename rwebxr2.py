@@ -1,17 +1,28 @@
 # RoverWEBXR.py  -- fixed global handling in api_command
 # Based on your uploaded file. See original upload for reference. :contentReference[oaicite:1]{index=1}
 
-import RPi.GPIO as GPIO
+import collections
+import json
+import math
+import os
 import time
 import threading
 import subprocess
 from flask import Flask, render_template_string, request, jsonify
 
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None     # off-Pi: only allowed with encoder_simulate, see below
+
+try:
+    import pigpio   # optional, hardware PWM via the pigpiod daemon
+except ImportError:
+    pigpio = None
+
 # --------------------------
 # GPIO CONFIG (BOARD MODE)
 # --------------------------
-GPIO.setmode(GPIO.BOARD)
-
 IN1 = 29
 IN2 = 31
 IN3 = 35
@@ -22,6 +33,127 @@ ENB = 32
 TRIG = 16
 ECHO = 18
 
+# Wheel encoders (optional, switched on in the motor profile). Each side's
+# slotted disc is edge-counted through GPIO callbacks and a PI loop holds the
+# wheel speed requested via /api/speed.
+ENC_A = 11
+ENC_B = 13
+ENCODER_PPR = 40           # counted edges per wheel revolution (both edges)
+MAX_RPM = 160              # nominal wheel RPM at 100% duty
+SPEED_HEADROOM = 0.85      # speed 100% targets this fraction of MAX_RPM, leaving
+                           # the weaker motor room to correct
+CAP_RELAX = 20             # RPM/s the shared cap rises once no side is saturated
+SATURATED_TICKS = 10       # ticks pinned at 100% before a side limits both (0.5 s)
+CONTROL_HZ = 20
+RPM_WINDOW = 5             # control ticks averaged per RPM estimate (0.25 s)
+KP = 0.15                  # duty % per RPM of error
+KI = 0.6                   # duty % per RPM*s of accumulated error
+I_LIMIT = 40               # clamp on the integral term (duty %)
+RAMP_SETTLED = 1.0         # integrate only once applied duty is this close to target
+
+# Motor driver profile. These defaults are overridden by motor_profile.json next
+# to this script (or the file named by $MOTOR_PROFILE).
+MOTOR_PROFILE = {
+    "pwm_backend": "auto",   # "auto", "pigpio" (hardware PWM) or "rpigpio" (software)
+    "pwm_frequency": 1000,   # Hz
+    "min_duty": 0,           # lowest duty that actually turns the wheels, %
+    "ramp_rate": 200,        # max duty change, % per second (0 = no ramp)
+    "dead_time": 0.1,        # seconds a side stays unpowered before reversing
+    "encoder_enabled": False,   # closed-loop speed control from wheel encoders
+    "encoder_simulate": False,  # fake encoder ticks from the applied duty; runs
+                                # off-Pi with GPIO stubbed out
+}
+MOTOR_PROFILE_PATH = os.environ.get(
+    "MOTOR_PROFILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "motor_profile.json"))
+DRIVE_HZ = 50
+
+# Hardware PWM channels: BOARD pin -> BCM GPIO (PWM0 on 32, PWM1 on 33)
+HW_PWM_GPIO = {32: 12, 33: 13}
+
+def load_motor_profile(path):
+    # All-or-nothing: a bad file keeps every default
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object")
+        unknown = set(data) - set(MOTOR_PROFILE)
+        if unknown:
+            raise ValueError("unknown keys: %s" % ", ".join(sorted(unknown)))
+        profile = dict(MOTOR_PROFILE, **data)
+        for key in ("pwm_frequency", "min_duty", "ramp_rate", "dead_time"):
+            # bool is an int subclass, so true would otherwise load as 1
+            if isinstance(profile[key], bool):
+                raise ValueError("%s must be a number" % key)
+            profile[key] = float(profile[key])
+            # json accepts Infinity/NaN, which slip past the range checks
+            if not math.isfinite(profile[key]):
+                raise ValueError("%s must be finite" % key)
+        profile["pwm_frequency"] = int(profile["pwm_frequency"])
+        for key in ("encoder_enabled", "encoder_simulate"):
+            if not isinstance(profile[key], bool):
+                raise ValueError("%s must be true or false" % key)
+        if profile["pwm_backend"] not in ("auto", "pigpio", "rpigpio"):
+            raise ValueError("pwm_backend must be auto, pigpio or rpigpio")
+        if profile["pwm_frequency"] <= 0:
+            raise ValueError("pwm_frequency must be > 0")
+        if not 0 <= profile["min_duty"] <= 100:
+            raise ValueError("min_duty must be within 0-100")
+        if profile["ramp_rate"] < 0 or profile["dead_time"] < 0:
+            raise ValueError("ramp_rate and dead_time must be >= 0")
+        MOTOR_PROFILE.update(profile)
+        print("Loaded motor profile from", path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, TypeError) as e:
+        print("Ignoring motor profile %s: %s" % (path, e))
+
+load_motor_profile(MOTOR_PROFILE_PATH)
+
+ENCODER_SIMULATE = MOTOR_PROFILE["encoder_simulate"]
+ENCODER_ENABLED = MOTOR_PROFILE["encoder_enabled"] or ENCODER_SIMULATE
+
+class SimGPIO:
+    """No-op stand-in for RPi.GPIO so the encoder simulation runs off-Pi"""
+    BOARD = OUT = IN = PUD_UP = BOTH = None
+
+    class PWM:
+        def __init__(self, pin, frequency):
+            pass
+
+        def start(self, dc):
+            pass
+
+        def ChangeDutyCycle(self, dc):
+            pass
+
+        def stop(self):
+            pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None):
+        pass
+
+    def output(self, pin, value):
+        pass
+
+    def input(self, pin):
+        return 0
+
+    def cleanup(self):
+        pass
+
+if GPIO is None:
+    if not ENCODER_SIMULATE:
+        raise ImportError("RPi.GPIO is required unless encoder_simulate is set")
+    print("RPi.GPIO not available, simulating GPIO")
+    GPIO = SimGPIO()
+
+GPIO.setmode(GPIO.BOARD)
+
 # Setup motor pins
 GPIO.setup(IN1, GPIO.OUT)
 GPIO.setup(IN2, GPIO.OUT)
@@ -35,17 +167,74 @@ GPIO.setup(TRIG, GPIO.OUT)
 GPIO.setup(ECHO, GPIO.IN)
 
 # PWM
-pwmA = GPIO.PWM(ENA, 1000)
-pwmB = GPIO.PWM(ENB, 1000)
-pwmA.start(70)
-pwmB.start(70)
+class HardwarePWM:
+    """pigpio hardware PWM with the part of RPi.GPIO's PWM API used here"""
+    def __init__(self, pin, frequency):
+        self.gpio = HW_PWM_GPIO[pin]
+        self.frequency = int(frequency)
+
+    def start(self, dc):
+        self.ChangeDutyCycle(dc)
+
+    def ChangeDutyCycle(self, dc):
+        pigpio_pi.hardware_PWM(self.gpio, self.frequency, int(dc * 10000))
+
+    def stop(self):
+        pigpio_pi.hardware_PWM(self.gpio, 0, 0)
+
+pigpio_pi = None
+
+def make_pwm(pin):
+    global pigpio_pi
+    backend = MOTOR_PROFILE["pwm_backend"]
+    frequency = MOTOR_PROFILE["pwm_frequency"]
+    if backend in ("auto", "pigpio") and pigpio is not None and pin in HW_PWM_GPIO:
+        if pigpio_pi is None:
+            pigpio_pi = pigpio.pi()
+        if pigpio_pi.connected:
+            return HardwarePWM(pin, frequency)
+    if backend == "pigpio":
+        print("Hardware PWM unavailable on pin %d, using RPi.GPIO" % pin)
+    return GPIO.PWM(pin, frequency)
+
+def stop_pwm():
+    pwmA.stop()
+    pwmB.stop()
+    if pigpio_pi is not None and pigpio_pi.connected:
+        pigpio_pi.stop()
 
-motor_lock = threading.Lock()
+# Enable lines start at 0%; the drive loop ramps them up once a move is requested
+pwmA = make_pwm(ENA)
+pwmB = make_pwm(ENB)
+pwmA.start(0)
+pwmB.start(0)
+
+# Re-entrant: api_command holds it while calling forward() etc.
+motor_lock = threading.RLock()
 current_action = "stop"
 current_speed = 70
 running = True
 last_distance = 0
 
+DRIVE_ACTIONS = ("forward", "backward", "left", "right")
+trim = {"a": 0.0, "b": 0.0}           # per-side correction, % of target
+target_duty = {"a": 70.0, "b": 70.0}  # duty the drive loop ramps towards
+duty = {"a": 0.0, "b": 0.0}           # ramped duty currently applied to ENA / ENB
+# Per-side direction, +1 forward / -1 reverse / 0 off. A = IN1/IN2, B = IN3/IN4
+DIRECTIONS = {
+    "stop": (0, 0),
+    "forward": (1, 1),
+    "backward": (-1, -1),
+    "left": (1, -1),
+    "right": (-1, 1),
+}
+requested_dir = {"a": 0, "b": 0}
+applied_dir = {"a": 0, "b": 0}
+flip_at = {"a": 0.0, "b": 0.0}        # earliest time a side may be re-energized
+measured_rpm = {"a": 0.0, "b": 0.0}
+enc_counts = {"a": 0, "b": 0}
+enc_lock = threading.Lock()
+
 # --------------------------
 # ULTRASONIC FUNCTION
 # --------------------------
@@ -82,56 +271,217 @@ def get_distance():
 # --------------------------
 # MOTOR FUNCTIONS
 # --------------------------
+def _write_side(side, direction):
+    # Caller holds motor_lock
+    pin1, pin2 = (IN1, IN2) if side == "a" else (IN3, IN4)
+    GPIO.output(pin1, direction < 0)
+    GPIO.output(pin2, direction > 0)
+    if direction == 0 and applied_dir[side] != 0:
+        flip_at[side] = time.time() + MOTOR_PROFILE["dead_time"]
+    applied_dir[side] = direction
+
+def _drive(action):
+    # Direction changes are sequenced (ramp down, dead time, ramp up) by drive_loop
+    global current_action
+    with motor_lock:
+        requested_dir["a"], requested_dir["b"] = DIRECTIONS[action]
+        current_action = action
+
 def stop():
     global current_action
     with motor_lock:
-        GPIO.output(IN1, False)
-        GPIO.output(IN2, False)
-        GPIO.output(IN3, False)
-        GPIO.output(IN4, False)
+        for side in ("a", "b"):
+            requested_dir[side] = 0
+            _write_side(side, 0)
+            duty[side] = 0.0
         current_action = "stop"
 
 def forward():
-    global current_action
-    with motor_lock:
-        GPIO.output(IN1, False)
-        GPIO.output(IN2, True)
-        GPIO.output(IN3, False)
-        GPIO.output(IN4, True)
-        current_action = "forward"
+    _drive("forward")
 
 def backward():
-    global current_action
-    with motor_lock:
-        GPIO.output(IN1, True)
-        GPIO.output(IN2, False)
-        GPIO.output(IN3, True)
-        GPIO.output(IN4, False)
-        current_action = "backward"
+    _drive("backward")
 
 def left():
-    global current_action
-    with motor_lock:
-        GPIO.output(IN1, False)
-        GPIO.output(IN2, True)
-        GPIO.output(IN3, True)
-        GPIO.output(IN4, False)
-        current_action = "left"
+    _drive("left")
 
 def right():
-    global current_action
-    with motor_lock:
-        GPIO.output(IN1, True)
-        GPIO.output(IN2, False)
-        GPIO.output(IN3, False)
-        GPIO.output(IN4, True)
-        current_action = "right"
+    _drive("right")
+
+def set_target_duty(a, b):
+    target_duty["a"] = max(0, min(100, a))
+    target_duty["b"] = max(0, min(100, b))
 
 def set_speed(speed):
     global current_speed
     current_speed = max(0, min(100, speed))
-    pwmA.ChangeDutyCycle(current_speed)
-    pwmB.ChangeDutyCycle(current_speed)
+    # With encoders the control loop owns the duty and picks this up next tick
+    if not ENCODER_ENABLED:
+        set_target_duty(current_speed * (1 + trim["a"] / 100.0),
+                        current_speed * (1 + trim["b"] / 100.0))
+
+def set_trim(a, b):
+    trim["a"] = max(-50, min(50, a))
+    trim["b"] = max(-50, min(50, b))
+    set_speed(current_speed)
+
+# --------------------------
+# WHEEL ENCODERS + SPEED CONTROL
+# --------------------------
+def _enc_edge_a(channel):
+    with enc_lock:
+        enc_counts["a"] += 1
+
+def _enc_edge_b(channel):
+    with enc_lock:
+        enc_counts["b"] += 1
+
+def setup_encoders():
+    global ENCODER_ENABLED
+    if not ENCODER_ENABLED or ENCODER_SIMULATE:
+        return
+    try:
+        GPIO.setup(ENC_A, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(ENC_B, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(ENC_A, GPIO.BOTH, callback=_enc_edge_a)
+        GPIO.add_event_detect(ENC_B, GPIO.BOTH, callback=_enc_edge_b)
+    except (RuntimeError, AttributeError) as e:
+        # Never close the loop on made-up ticks with real motors attached
+        print("Encoder setup failed (%s), using open-loop speed control" % e)
+        ENCODER_ENABLED = False
+        set_speed(current_speed)
+
+# Simulated motors are deliberately mismatched so the loop has something to do
+SIM_GAIN = {"a": 1.0, "b": 0.9}
+_sim_accum = {"a": 0.0, "b": 0.0}
+
+def _simulate_encoders(dt):
+    with enc_lock:
+        for side in ("a", "b"):
+            if applied_dir[side] == 0:
+                continue
+            rpm = duty[side] / 100.0 * MAX_RPM * SIM_GAIN[side]
+            _sim_accum[side] += rpm / 60.0 * ENCODER_PPR * dt
+            ticks = int(_sim_accum[side])
+            _sim_accum[side] -= ticks
+            enc_counts[side] += ticks
+
+def speed_control_loop():
+    """PI loop holding both wheels at a common, reachable speed"""
+    integral = {"a": 0.0, "b": 0.0}
+    rpm_cap = float("inf")   # common target cap, set by a side stuck at 100%
+    pinned = {"a": 0, "b": 0}
+    # (edges, dt) per tick; one tick alone only resolves 60 / (PPR * dt) RPM
+    window = {side: collections.deque(maxlen=RPM_WINDOW) for side in ("a", "b")}
+    period = 1.0 / CONTROL_HZ
+    last = time.time()
+    next_tick = last + period
+    while running:
+        time.sleep(max(0, next_tick - time.time()))
+        now = time.time()
+        # Fixed rate; if we fell badly behind, resync instead of bursting
+        next_tick = max(next_tick + period, now)
+        dt = now - last
+        last = now
+        if dt <= 0:
+            continue
+
+        if ENCODER_SIMULATE:
+            _simulate_encoders(dt)
+        with enc_lock:
+            counts = dict(enc_counts)
+            enc_counts["a"] = 0
+            enc_counts["b"] = 0
+        for side in ("a", "b"):
+            window[side].append((counts[side], dt))
+            edges = sum(c for c, _ in window[side])
+            span = sum(t for _, t in window[side])
+            measured_rpm[side] = edges * 60.0 / (ENCODER_PPR * span)
+
+        if current_action not in DRIVE_ACTIONS:
+            integral["a"] = integral["b"] = 0.0
+            rpm_cap = float("inf")
+            pinned["a"] = pinned["b"] = 0
+            continue
+
+        # Trims are relative, so normalise them: no side is asked to go faster
+        # than the common target
+        top = max(1 + trim[side] / 100.0 for side in ("a", "b"))
+        scale = {side: (1 + trim[side] / 100.0) / top for side in ("a", "b")}
+        nominal = current_speed / 100.0 * MAX_RPM * SPEED_HEADROOM
+        base = min(nominal, rpm_cap)
+
+        out = {}
+        reachable = []
+        for side in ("a", "b"):
+            target = base * scale[side]
+            err = target - measured_rpm[side]
+            feedforward = target / MAX_RPM * 100
+            unclamped = feedforward + KP * err + integral[side]
+            # Anti-windup: drive_loop holds the wheel off during a reversal and
+            # limits it while ramping, and the output clamps at 0-100%, so don't
+            # integrate error the motor can't act on
+            pushing_limit = (unclamped >= 100 and err > 0) or (unclamped <= 0 and err < 0)
+            if applied_dir[side] != requested_dir[side]:
+                integral[side] = 0.0
+            elif abs(duty[side] - target_duty[side]) <= RAMP_SETTLED and not pushing_limit:
+                integral[side] = max(-I_LIMIT, min(I_LIMIT, integral[side] + KI * err * dt))
+            out[side] = feedforward + KP * err + integral[side]
+            # Held at the limit longer than a start-up P kick lasts
+            pinned[side] = pinned[side] + 1 if out[side] >= 100 and err > 0 else 0
+            if pinned[side] >= SATURATED_TICKS:
+                reachable.append(measured_rpm[side] / scale[side])
+        set_target_duty(out["a"], out["b"])
+
+        # A side pinned at 100% sets the pace for both so they stay matched;
+        # otherwise let the cap creep back up to find the new limit
+        if reachable:
+            rpm_cap = min(reachable)
+        elif rpm_cap < nominal:
+            rpm_cap += CAP_RELAX * dt
+        else:
+            rpm_cap = float("inf")
+
+def drive_loop():
+    """Sequence direction changes and ramp the applied duty toward target_duty"""
+    pwm = {"a": pwmA, "b": pwmB}
+    written = {"a": 0.0, "b": 0.0}
+    period = 1.0 / DRIVE_HZ
+    last = time.time()
+    next_tick = last + period
+    while running:
+        time.sleep(max(0, next_tick - time.time()))
+        now = time.time()
+        next_tick = max(next_tick + period, now)
+        dt = now - last
+        last = now
+
+        rate = MOTOR_PROFILE["ramp_rate"]
+        step = rate * dt if rate > 0 else 100
+        min_duty = MOTOR_PROFILE["min_duty"]
+        with motor_lock:
+            for side in ("a", "b"):
+                want = requested_dir[side]
+                have = applied_dir[side]
+                if have != want and have != 0:
+                    # Reversing: ramp to zero, then release the H-bridge
+                    goal = 0
+                    if duty[side] <= 0:
+                        _write_side(side, 0)
+                elif have != want:
+                    # Unpowered: re-energize once the dead time has passed
+                    goal = 0
+                    if now >= flip_at[side]:
+                        _write_side(side, want)
+                else:
+                    goal = target_duty[side] if want else 0
+
+                d = duty[side]
+                duty[side] = min(goal, d + step) if goal > d else max(goal, d - step)
+                out = max(min_duty, duty[side]) if duty[side] > 0 else 0
+                if out != written[side]:
+                    pwm[side].ChangeDutyCycle(out)
+                    written[side] = out
 
 # --------------------------
 # SHUTDOWN FUNCTION
@@ -149,8 +499,7 @@ def safe_shutdown():
     time.sleep(0.5)
     
     # Stop PWM
-    pwmA.stop()
-    pwmB.stop()
+    stop_pwm()
     
     # Cleanup GPIO
     GPIO.cleanup()
@@ -209,6 +558,7 @@ HTML = r"""
     <div><b>Action:</b> <span id="action">STOP</span></div>
     <div><b>Speed:</b> <span id="speed">--</span>%</div>
     <div><b>Distance:</b> <span id="distance">--</span> cm</div>
+    <div><b>RPM:</b> <span id="rpm">--</span></div>
     <div style="margin-top:6px">
       <button id="btnCam" class="small">Toggle Camera</button>
       <button id="btnTest" class="small">Test API</button>
@@ -222,6 +572,7 @@ HTML = r"""
    It calls the Flask endpoints served by this same server:
      POST /api/command  { command: "forward"|"backward"|"left"|"right"|"stop"|"on"|"off" }
      POST /api/speed    { speed: <0-100> }
+     POST /api/trim     { a: <-50..50>, b: <-50..50> }
      GET  /api/status
      POST /api/shutdown
 */
@@ -258,6 +609,7 @@ async function pollStatusOnce(){
     document.getElementById('action').textContent = (j.action||'--').toUpperCase();
     document.getElementById('speed').textContent = (j.speed==null ? '--' : j.speed);
     document.getElementById('distance').textContent = (j.distance==null ? '--' : j.distance);
+    document.getElementById('rpm').textContent = (j.rpm==null ? '--' : j.rpm.a + ' / ' + j.rpm.b);
   }catch(e){}
 }
 
@@ -639,12 +991,23 @@ def api_speed():
     set_speed(speed)
     return jsonify({"status": "ok", "speed": current_speed})
 
+@app.route("/api/trim", methods=["POST"])
+def api_trim():
+    data = request.get_json()
+    set_trim(data.get("a", trim["a"]), data.get("b", trim["b"]))
+    return jsonify({"status": "ok", "trim": trim})
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
     return jsonify({
         "action": current_action,
         "speed": current_speed,
-        "distance": last_distance
+        "distance": last_distance,
+        "trim": trim,
+        "duty": {side: round(d, 1) for side, d in duty.items()},
+        # None (shown as "--") rather than 0 RPM when there is no sensor
+        "rpm": ({side: round(r, 1) for side, r in measured_rpm.items()}
+                if ENCODER_ENABLED else None)
     })
 
 @app.route("/api/shutdown", methods=["POST"])
@@ -669,6 +1032,10 @@ def api_shutdown():
 if __name__ == "__main__":
     try:
         threading.Thread(target=safety_loop, daemon=True).start()
+        threading.Thread(target=drive_loop, daemon=True).start()
+        setup_encoders()
+        if ENCODER_ENABLED:
+            threading.Thread(target=speed_control_loop, daemon=True).start()
         print("=" * 50)
         print("🚗 RC Car Controller Started!")
         print("=" * 50)
@@ -682,7 +1049,6 @@ if __name__ == "__main__":
     finally:
         running = False
         stop()
-        pwmA.stop()
-        pwmB.stop()
+        stop_pwm()
         GPIO.cleanup()
         print("\n✅ EXIT: GPIO cleaned")